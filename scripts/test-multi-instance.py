@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+"""
+Check that several target selector instances sharing a Redis stream apply
+each UPDATE exactly once, including when an instance dies.
+
+Requires a local Redis (>= 6.2) and the target selector's MySQL database.
+The UPDATEs refer to test sources added to the `targets` table for the
+duration of the test, so the scores of other sources are not changed.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import redis
+
+from target_selector.triage import Triage
+from target_selector.stream import MAX_DELIVERIES
+
+OBSID = "test:array:0"
+MISSING_OBSID = "test:array:missing"
+POINTING_OBSID = "test:array:pointing"
+SOURCES = [f"test_source_{i}" for i in range(3)]
+# Each UPDATE adds t*nsegs*nants to the score of each source
+T = 300
+NSEGS = 1
+NANTS = 60
+
+def cli(args = sys.argv[0]):
+    usage = "{} [options]".format(args)
+    description = "Test several target selector instances against one Redis."
+    parser = argparse.ArgumentParser(prog = "test-multi-instance",
+                                     usage = usage,
+                                     description = description)
+    parser.add_argument("--redis_endpoint",
+                        type = str,
+                        default = "127.0.0.1:6379",
+                        help = "Local Redis endpoint.")
+    parser.add_argument("--config_file",
+                        type = str,
+                        default = "config.yml",
+                        help = "Database configuration file.")
+    parser.add_argument("--stream",
+                        type = str,
+                        default = "target-selector:test",
+                        help = "Redis stream to test with (deleted first).")
+    parser.add_argument("--instances",
+                        type = int,
+                        default = 3,
+                        help = "Number of target selector instances.")
+    parser.add_argument("--updates",
+                        type = int,
+                        default = 50,
+                        help = "Number of UPDATE messages to send.")
+    parser.add_argument("--claim_idle",
+                        type = int,
+                        default = 80000,
+                        help = "Time (ms) after which pending work is claimed.")
+    parser.add_argument("--timeout",
+                        type = int,
+                        default = 600,
+                        help = "Time (s) to wait for all work to be done.")
+    args = parser.parse_args()
+    passed = main(redis_endpoint = args.redis_endpoint,
+                  config_file = args.config_file,
+                  stream = args.stream,
+                  instances = args.instances,
+                  updates = args.updates,
+                  claim_idle = args.claim_idle,
+                  timeout = args.timeout)
+    sys.exit(0 if passed else 1)
+
+def update_msg(obsid):
+    """An UPDATE message for the test observation.
+    """
+    update = {"nsegs":NSEGS, "band":"l", "t":T, "nants":NANTS, "obsid":obsid,
+              "nbeams":len(SOURCES)}
+    return {"data":f"UPDATE:{json.dumps(update)}"}
+
+def start_instance(redis_endpoint, config_file, stream, group, consumer,
+                   claim_idle, log_dir):
+    """Start a target selector instance in a separate process.
+    """
+    log_file = open(os.path.join(log_dir, f"{consumer}.log"), "w")
+    cmd = [sys.executable, "-u", "-m", "target_selector.cli",
+           f"--redis_endpoint={redis_endpoint}",
+           f"--config_file={config_file}",
+           f"--pointing_channel={stream}:pointings",
+           f"--processing_channel={stream}:processing",
+           f"--targets_channel={stream}:targets",
+           f"--stream={stream}",
+           f"--group={group}",
+           f"--consumer={consumer}",
+           f"--claim_idle={claim_idle}"]
+    return subprocess.Popen(cmd, stdout=log_file, stderr=subprocess.STDOUT)
+
+def ledger(triage, stream):
+    """Entry IDs recorded as applied for `stream`.
+    """
+    with triage.connection.cursor() as cursor:
+        cursor.execute("SELECT msg_id FROM applied_updates WHERE stream = %s",
+                       (stream,))
+        rows = cursor.fetchall()
+    triage.connection.commit()
+    return [row[0] for row in rows]
+
+def remove_sources(triage):
+    """Remove the test sources from the targets table.
+    """
+    with triage.connection.cursor() as cursor:
+        cursor.executemany("DELETE FROM targets WHERE source_id = %s",
+                           [(source_id,) for source_id in SOURCES])
+    triage.connection.commit()
+
+def add_sources(triage):
+    """Add the test sources to the targets table, with zero scores. They are
+    placed near the south pole, away from the test POINTING.
+    """
+    remove_sources(triage)
+    insert = ("INSERT INTO targets (source_id, ra, decl, dist_c, uhf, l, s0, "
+              "s1, s2, s3, s4) VALUES (%s, 0, -89, 0, 0, 0, 0, 0, 0, 0, 0)")
+    with triage.connection.cursor() as cursor:
+        cursor.executemany(insert, [(source_id,) for source_id in SOURCES])
+    triage.connection.commit()
+
+def scores(triage):
+    """L-band scores of the test sources.
+    """
+    placeholders = ", ".join(["%s"]*len(SOURCES))
+    with triage.connection.cursor() as cursor:
+        cursor.execute("SELECT source_id, l FROM targets WHERE source_id IN "
+                       f"({placeholders})", tuple(SOURCES))
+        rows = cursor.fetchall()
+    triage.connection.commit()
+    return dict(rows)
+
+def main(redis_endpoint, config_file, stream, instances, updates, claim_idle,
+         timeout):
+    """Runs the test, returning True if it passed.
+    """
+    group = f"{stream}:group"
+    redis_host, redis_port = redis_endpoint.split(':')
+    r = redis.StrictRedis(host=redis_host, port=redis_port,
+                          decode_responses=True)
+    triage = Triage(config_file, redis_endpoint)
+    triage.create_ledger()
+
+    print("Clearing previous test data")
+    for key in r.scan_iter(f"{stream}*"):
+        r.delete(key)
+    with triage.connection.cursor() as cursor:
+        cursor.execute("DELETE FROM applied_updates WHERE stream = %s",
+                       (stream,))
+    triage.connection.commit()
+    add_sources(triage)
+    targets = [{"source_id":source_id, "ra":0, "dec":-89}
+               for source_id in SOURCES]
+    r.set(f"targets:{OBSID}", json.dumps(targets))
+    r.delete(f"targets:{MISSING_OBSID}")
+    r.delete(f"targets:{POINTING_OBSID}")
+    r.xgroup_create(stream, group, id='0', mkstream=True)
+
+    print("Simulating an instance that died while handling entries")
+    # One entry applied but not acknowledged, one not applied at all, and one
+    # that fails every time it is handled:
+    applied = r.xadd(stream, update_msg(OBSID))
+    unapplied = r.xadd(stream, update_msg(OBSID))
+    poison = r.xadd(stream, update_msg(MISSING_OBSID))
+    r.xreadgroup(group, "test-dead", {stream:'>'}, count=3)
+    triage.update_targets("l", SOURCES, T, NSEGS, NANTS, stream, applied,
+                          OBSID)
+    r.xclaim(stream, group, "test-dead", 0, [poison],
+             retrycount=MAX_DELIVERIES)
+    expected = [applied, unapplied]
+
+    log_dir = tempfile.mkdtemp(prefix="targetselector-test-")
+    print(f"Starting {instances} instances (logs in {log_dir})")
+    procs = [start_instance(redis_endpoint, config_file, stream, group,
+                            f"test-{i}", claim_idle, log_dir)
+             for i in range(instances)]
+    try:
+        t_start = time.time()
+        while r.pubsub_numsub(f"{stream}:pointings")[0][1] < instances:
+            if time.time() - t_start > 60:
+                print("FAIL: instances did not start")
+                return False
+            time.sleep(1)
+
+        print("Publishing a POINTING twice")
+        # With its own obsid, so its targets do not replace those of `OBSID`
+        pointing = {"telescope":"test", "array":"array",
+                    "pktstart_str":"pointing",
+                    "target":"test", "ra_deg":0, "dec_deg":0, "f_max":1000,
+                    "band":"l"}
+        pointing_msg = f"POINTING:{json.dumps(pointing)}"
+        r.publish(f"{stream}:pointings", pointing_msg)
+        r.publish(f"{stream}:pointings", pointing_msg)
+
+        print(f"Sending {updates} UPDATEs, killing test-0 halfway")
+        for i in range(updates):
+            if i == updates//2:
+                procs[0].kill()
+            expected.append(r.xadd(stream, update_msg(OBSID)))
+            time.sleep(0.05)
+
+        print("Waiting for all entries to be handled")
+        t_start = time.time()
+        while True:
+            consumers = [c["name"] for c in r.xinfo_consumers(stream, group)]
+            done = (r.xpending(stream, group)["pending"] == 0
+                    and len(ledger(triage, stream)) >= len(expected)
+                    and "test-dead" not in consumers
+                    and "test-0" not in consumers)
+            if done:
+                break
+            if time.time() - t_start > timeout:
+                print("FAIL: timed out waiting for entries to be handled")
+                break
+            time.sleep(5)
+    finally:
+        for proc in procs:
+            proc.terminate()
+            proc.wait()
+        r.delete(f"targets:{POINTING_OBSID}")
+        final_scores = scores(triage)
+        remove_sources(triage)
+
+    passed = True
+    applied_ids = ledger(triage, stream)
+    for msg_id in expected:
+        if msg_id not in applied_ids:
+            print(f"FAIL: {msg_id} not applied")
+            passed = False
+    # Checks that no UPDATE changed the scores more than once:
+    expected_score = len(expected)*T*NSEGS*NANTS
+    for source_id in SOURCES:
+        score = final_scores.get(source_id)
+        if score != expected_score:
+            print(f"FAIL: {source_id} has score {score}, "
+                  f"expected {expected_score}")
+            passed = False
+    if len(applied_ids) != len(expected):
+        print(f"FAIL: {len(applied_ids)} UPDATEs applied, "
+              f"expected {len(expected)}")
+        passed = False
+    if poison in applied_ids:
+        print(f"FAIL: {poison} applied")
+        passed = False
+    pending = r.xpending(stream, group)["pending"]
+    if pending != 0:
+        print(f"FAIL: {pending} entries still pending")
+        passed = False
+    forwarded = [e for e in r.xrange(stream) if e[1]["data"] == pointing_msg]
+    if len(forwarded) != 1:
+        print(f"FAIL: POINTING forwarded {len(forwarded)} times")
+        passed = False
+    consumers = [c["name"] for c in r.xinfo_consumers(stream, group)]
+    for consumer in ["test-dead", "test-0"]:
+        if consumer in consumers:
+            print(f"FAIL: consumer {consumer} not removed")
+            passed = False
+    print("PASS" if passed else "FAIL")
+    return passed
+
+if(__name__ == '__main__'):
+    cli()
@@ -2,7 +2,7 @@ import setuptools
 
 requires = [
     'numpy >= 1.18.1',
-    'redis >= 3.4.1',
+    'redis >= 4.0.0',
     'PyYAML >= 6.0',
     'scipy >= 1.8.0',
     'mysql-connector-python==8.2.0'
@@ -2,6 +2,7 @@ import argparse
 import sys
 
 from target_selector.selector import Selector
+from target_selector.stream import StreamSelector, CLAIM_IDLE
 from target_selector.logger import set_logger
 
 def cli(args = sys.argv[0]):
@@ -36,6 +37,26 @@ def cli(args = sys.argv[0]):
                         type = float,
                         default = 13.5,
                         help = 'Diameter of antenna for generic FoV estimate.')
+    parser.add_argument('--stream',
+                        type = str,
+                        default = None,
+                        help = 'Redis stream through which work is shared '
+                               'between several instances. If not given, '
+                               'only a single instance may run.')
+    parser.add_argument('--group',
+                        type = str,
+                        default = 'target-selector',
+                        help = 'Consumer group shared by all instances.')
+    parser.add_argument('--consumer',
+                        type = str,
+                        default = None,
+                        help = 'Name of this instance within the group '
+                               '(default <hostname>:<pid>).')
+    parser.add_argument('--claim_idle',
+                        type = int,
+                        default = CLAIM_IDLE,
+                        help = 'Time (ms) after which work left pending by '
+                               'another instance is taken over.')
     if(len(sys.argv[1:]) == 0):
         parser.print_help()
         parser.exit()
@@ -45,10 +66,15 @@ def cli(args = sys.argv[0]):
          targets_chan = args.targets_channel,
          proc_chan = args.processing_channel,
          config_file = args.config_file,
-         diameter = args.diameter)
+         diameter = args.diameter,
+         stream = args.stream,
+         group = args.group,
+         consumer = args.consumer,
+         claim_idle = args.claim_idle)
 
 def main(redis_endpoint, pointing_chan, targets_chan, proc_chan, config_file,
-         diameter):
+         diameter, stream=None, group=None, consumer=None,
+         claim_idle=CLAIM_IDLE):
     """Starts the minimal target selector.
 
     Args:
@@ -62,10 +88,22 @@ def main(redis_endpoint, pointing_chan, targets_chan, proc_chan, config_file,
         config_file (str): Location of the database config file (yml).
         d (float): diameter of telescope antenna (used in generic FoV
         calculation) in meters.
+        stream (str): Redis stream shared by all instances. If None, run as
+        a single instance reading directly from the channels above.
+        group (str): Consumer group shared by all instances.
+        consumer (str): Name of this instance within the group.
+        claim_idle (int): Time (ms) after which work left pending by another
+        instance is taken over.
     """
     set_logger('DEBUG')
-    TargetSelector = Selector(redis_endpoint, pointing_chan, targets_chan,
-                              proc_chan, config_file, diameter)
+    if stream is None:
+        TargetSelector = Selector(redis_endpoint, pointing_chan, targets_chan,
+                                  proc_chan, config_file, diameter)
+    else:
+        TargetSelector = StreamSelector(redis_endpoint, pointing_chan,
+                                        targets_chan, proc_chan, config_file,
+                                        diameter, stream, group, consumer,
+                                        claim_idle)
     TargetSelector.start()
 
 if(__name__ == '__main__'):
@@ -39,6 +39,9 @@ class Selector(object):
         self.proc_channel = processing
         self.triage = Triage(config_file, redis_ep)
         self.diameter = diameter
+        # If False, targets are still published when the database is not
+        # available (containing only the primary pointing):
+        self.raise_db_errors = False
 
     def start(self):
         """Start the target selector.
@@ -53,25 +56,39 @@ class Selector(object):
             log.info(f"received msg {msg}")
             self.parse_msg(msg)
 
-    def parse_msg(self, msg):
+    def parse_msg(self, msg, msg_id=None):
         """Examines and parses incoming messages, and initiates the
         appropriate response.
+
+        Args:
+            msg (dict): Message with its contents under `data`.
+            msg_id (str): Unique ID of the message, if it has one (eg a Redis
+            stream entry ID).
+
+        Returns:
+            pending (bool): True if the message is still being handled in the
+            background (see `alert_delayed`).
         """
         msg_data = msg['data']
         msg_components = msg_data.split(':', 1)
         # Segment/subband successfully processed:
         if msg_components[0] == "UPDATE":
             log.info(f"Handling message: {msg_data}")
-            self.update(msg_components[1])
+            self.update(msg_components[1], msg_id)
         # New pointing, we need to supply new targets:
         elif msg_components[0] == "POINTING":
             log.info(f"Handling message: {msg_data}")
-            self.pointing(msg_components[1])
+            return self.pointing(msg_components[1], msg_id)
         else:
             log.warning(f"Unrecognised message: {msg_data}")
+        return False
 
-    def update(self, msg):
+    def update(self, msg, msg_id=None):
         """Processes an update message for a completed subband.
+
+        Args:
+            msg (str): JSON-formatted update message.
+            msg_id (str): Unique ID of the message, if it has one.
         """
         try:
             update = json.loads(msg)
@@ -90,21 +107,41 @@ class Selector(object):
             return
         # Get targets that were just processed
         targets = self.triage.get_targets(obsid, nbeams)
+        source_ids = [target["source_id"] for target in targets]
         t1 = time.time()
-        # In sequence for now; consider altering format in future
-        for target in targets:
-            self.triage.update(band, target["source_id"], t, nsegs, nants)
+        try:
+            if not self.apply_update(band, source_ids, t, nsegs, nants, obsid,
+                                     msg_id):
+                return
+        except ValueError:
+            log.error(f"Invalid band: {band}")
+            return
         td = time.time() - t1
         log.info(f"Updated target scores for {obsid} in {td} seconds")
 
-    def pointing(self, msg):
+    def apply_update(self, band, source_ids, t, nsegs, nants, obsid,
+                     msg_id=None):
+        """Applies the scores for a completed subband to its targets.
+
+        Returns:
+            applied (bool): True if the scores were updated.
+        """
+        # In sequence for now; consider altering format in future
+        for source_id in source_ids:
+            self.triage.update(band, source_id, t, nsegs, nants)
+        return True
+
+    def pointing(self, msg, msg_id=None):
         """Processes a request for targets in the FoV of a new pointing.
+
+        Returns:
+            pending (bool): True if the targets are yet to be published.
         """
         try:
             pointing = json.loads(msg)
         except json.decoder.JSONDecodeError:
             log.error("Invalid JSON")
-            return
+            return False
         try:
             telescope = pointing["telescope"]
             array = pointing["array"]
@@ -117,27 +154,37 @@ class Selector(object):
             obsid = f"{telescope}:{array}:{pktstart_str}"
         except KeyError as e:
             log.error(f"Missing key: {e}")
-            return
-        self.calc_targets(target, ra_deg, dec_deg, f_max, obsid, band)
+            return False
+        try:
+            self.calc_targets(target, ra_deg, dec_deg, f_max, obsid, band,
+                              msg_id)
+        except ValueError:
+            log.error(f"Invalid band: {band}")
+            return False
+        return True
 
-    def calc_targets(self, primary_src, ra_deg, dec_deg, f_max, obsid, band):
+    def calc_targets(self, primary_src, ra_deg, dec_deg, f_max, obsid, band,
+                     msg_id=None):
         """Calculates and communicates targets within the current field of
         view to downstream processes.
         """
         primary_target = {"source_id":primary_src, "ra":ra_deg, "dec":dec_deg}
         target_list = self.triage.rank_sources(ra_deg, dec_deg, self.diameter,
-                                               f_max, band)
+                                               f_max, band,
+                                               self.raise_db_errors)
         json_list = self.triage.format_targets(target_list, primary_target)
         # Write the list of targets to Redis under OBSID and alert listeners
         # that new targets are available:
         self.redis_server.set(f"targets:{obsid}", json_list)
         # Write in separate thread so as not to block other requests
-        t = threading.Thread(target=self.alert_delayed, args=(obsid, DELAY))
+        t = threading.Thread(target=self.alert_delayed,
+                             args=(obsid, DELAY, msg_id))
         t.start()
 
-    def alert_delayed(self, obsid, delay):
+    def alert_delayed(self, obsid, delay, msg_id=None):
         """Publish target alert after a delay of 60 + 15 seconds, required for
-        the `bfr5_generator`.
+        the `bfr5_generator`. `msg_id` is the ID of the originating message,
+        if it has one.
         """
         log.info(f'TEMP: sleeping for {delay} seconds for bfr5_generator.')
         time.sleep(delay)
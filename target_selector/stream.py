@@ -0,0 +1,273 @@
+import os
+import socket
+import threading
+import time
+import hashlib
+
+import redis
+from mysql.connector.errors import OperationalError, InterfaceError
+
+from target_selector.selector import Selector, DELAY
+from target_selector.logger import log
+from target_selector.util import alert
+
+CLAIM_IDLE = 120000 # milliseconds, must exceed DELAY
+SEEN_EXPIRY = 86400 # seconds
+# Records of applied UPDATEs are kept for far longer than any entry may stay
+# pending before being claimed or discarded.
+LEDGER_EXPIRY = 7*86400 # seconds
+BRIDGE_RETRIES = 5
+BRIDGE_RETRY_DELAY = 5 # seconds
+MAX_DELIVERIES = 5
+STREAM_MAXLEN = 100000
+# Errors that leave this instance unable to handle any entry. These stop the
+# process (to be restarted by circus) rather than using up delivery attempts.
+FATAL = (OperationalError, InterfaceError, redis.exceptions.ConnectionError,
+         redis.exceptions.TimeoutError)
+
+# Forward a message to the stream unless it has already been forwarded (by
+# any instance). Every instance receives every published message, so each is
+# written to the stream exactly once for as long as any instance is running.
+FORWARD = """
+if redis.call('SET', KEYS[1], 1, 'NX', 'EX', ARGV[1]) then
+    return redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[2], '*',
+                      'channel', ARGV[3], 'data', ARGV[4])
+end
+return false
+"""
+
+class StreamSelector(Selector):
+    """A target selector that shares its work with other instances via a
+    Redis stream consumer group, so that several may run at once.
+
+    Each entry in the stream is delivered to a single instance, and is only
+    acknowledged once it has been handled. Entries left unacknowledged by an
+    instance that has died are claimed by the remaining instances after
+    `claim_idle` milliseconds. POINTING entries are only acknowledged once
+    their targets have been published, `DELAY` seconds later. UPDATE messages
+    are recorded in the database in the same transaction as the score
+    updates, so a claimed UPDATE that was in fact already applied is not
+    applied again.
+
+    Messages published to the pointing channel are forwarded into the stream
+    by the first instance to receive them. Identical POINTING messages
+    describe the same observation, so duplicates are discarded. This is not
+    true of UPDATE messages, which must instead be added to the stream
+    directly by their producers.
+    """
+
+    def __init__(self, redis_ep, pointings, targets, processing, config_file,
+                 diameter, stream, group, consumer=None,
+                 claim_idle=CLAIM_IDLE):
+        """Initialises a stream target selector instance.
+
+        Args:
+            redis_ep (str): Redis endpoint (<host IP address>:<port>)
+            pointings (str): Name of the channel from which the target
+            selector will receive new pointing information.
+            targets (str): Name of the channel to which the target selector
+            will publish target information.
+            processing (str): Name of the channel from which the target
+            selector will receive information about completed processing units.
+            config_file (str): Location of the database config file (yml).
+            diameter (float): diameter of antenna (used in generic FoV
+            calculation) in meters.
+            stream (str): Key of the Redis stream shared by all instances.
+            group (str): Name of the consumer group shared by all instances.
+            consumer (str): Name of this instance within the group. Defaults
+            to <hostname>:<pid>.
+            claim_idle (int): Time in milliseconds after which unacknowledged
+            entries belonging to another instance are claimed by this one.
+            Must exceed `DELAY`, so that POINTING entries awaiting publication
+            are not claimed from live instances.
+        """
+        if claim_idle <= DELAY*1000:
+            log.error(f"claim_idle must exceed {DELAY*1000} ms")
+            raise ValueError
+        super().__init__(redis_ep, pointings, targets, processing,
+                         config_file, diameter)
+        # Leave POINTING entries pending for another instance instead:
+        self.raise_db_errors = True
+        self.stream = stream
+        self.group = group
+        if consumer is None:
+            consumer = f"{socket.gethostname()}:{os.getpid()}"
+        self.consumer = consumer
+        self.claim_idle = claim_idle
+        self.forward = self.redis_server.register_script(FORWARD)
+
+    def start(self):
+        """Start the target selector.
+        """
+        log.info(f'Starting the target selector as {self.consumer}.')
+        self.triage.create_ledger()
+        try:
+            self.redis_server.xgroup_create(self.stream, self.group, id='0',
+                                            mkstream=True)
+        except redis.exceptions.ResponseError as e:
+            # The group has already been created by another instance
+            if 'BUSYGROUP' not in str(e):
+                raise
+        self.bridge_thread = threading.Thread(target=self.bridge, daemon=True)
+        self.bridge_thread.start()
+        log.info(f"Reading from stream: {self.stream} (group {self.group})")
+        log.info(f"Publishing results to: {self.targets_channel}")
+        self.consume()
+
+    def bridge(self):
+        """Forward messages from the pointing channel into the stream.
+
+        Messages on the processing channel are not forwarded, since repeated
+        identical UPDATE messages cannot be told apart from duplicates.
+
+        Lost connections to Redis are retried up to `BRIDGE_RETRIES` times in
+        a row. If the bridge stops, `consume` stops the process.
+        """
+        failures = 0
+        while failures < BRIDGE_RETRIES:
+            try:
+                ps = self.redis_server.pubsub(ignore_subscribe_messages=True)
+                ps.subscribe([self.pointing_channel, self.proc_channel])
+                log.info(f"Listening for new pointings on: "
+                         f"{self.pointing_channel}")
+                for msg in ps.listen():
+                    failures = 0
+                    self.relay(msg)
+            except (redis.exceptions.ConnectionError,
+                    redis.exceptions.TimeoutError) as e:
+                failures += 1
+                log.error(f"Bridge lost connection to Redis "
+                          f"({failures}/{BRIDGE_RETRIES}): {e}")
+                time.sleep(BRIDGE_RETRY_DELAY)
+            except Exception as e:
+                log.error(f"Bridge stopped: {e}")
+                return
+        log.error("Bridge could not reconnect to Redis")
+
+    def relay(self, msg):
+        """Forward a single pub/sub message into the stream, unless another
+        instance has already done so.
+        """
+        if msg['channel'] != self.pointing_channel:
+            log.warning(f"Ignoring msg on {msg['channel']}; add it to "
+                        f"{self.stream} instead: {msg['data']}")
+            return
+        digest = hashlib.sha1(msg['data'].encode()).hexdigest()
+        entry_id = self.forward(keys=[f"{self.stream}:seen:{digest}",
+                                      self.stream],
+                                args=[SEEN_EXPIRY, STREAM_MAXLEN,
+                                      msg['channel'], msg['data']])
+        if entry_id:
+            log.info(f"Forwarded msg to {self.stream} as {entry_id}")
+
+    def consume(self):
+        """Read and handle entries from the stream, claiming any that have
+        been left pending by other instances for longer than `claim_idle`.
+        """
+        last_claim = 0
+        while True:
+            if not self.bridge_thread.is_alive():
+                log.error("Bridge has stopped, stopping.")
+                raise RuntimeError("bridge stopped")
+            if time.time() - last_claim > self.claim_idle/2000:
+                self.claim()
+                last_claim = time.time()
+            response = self.redis_server.xreadgroup(self.group, self.consumer,
+                                                    {self.stream: '>'},
+                                                    count=10, block=1000)
+            for _, entries in response:
+                for entry_id, fields in entries:
+                    self.handle(entry_id, fields)
+
+    def claim(self):
+        """Claim entries left unacknowledged by other (probably dead)
+        instances, and handle them. Also removes consumers that have been
+        idle for longer than `claim_idle` and have no pending entries (eg
+        instances since restarted under a new name), and prunes old records
+        of applied UPDATEs.
+        """
+        self.triage.prune_ledger(self.stream, LEDGER_EXPIRY)
+        start_id = '0-0'
+        while True:
+            response = self.redis_server.xautoclaim(self.stream, self.group,
+                                                    self.consumer,
+                                                    self.claim_idle,
+                                                    start_id=start_id,
+                                                    count=10)
+            start_id, entries = response[0], response[1]
+            for entry_id, fields in entries:
+                pending = self.redis_server.xpending_range(self.stream,
+                                                           self.group,
+                                                           min=entry_id,
+                                                           max=entry_id,
+                                                           count=1)
+                if pending and pending[0]['times_delivered'] > MAX_DELIVERIES:
+                    log.error(f"Discarding {entry_id} after "
+                              f"{MAX_DELIVERIES} failed deliveries")
+                    alert(self.redis_server,
+                    f":warning: discarding message {entry_id}",
+                    "target selector")
+                    self.redis_server.xack(self.stream, self.group, entry_id)
+                    continue
+                log.info(f"Claimed {entry_id}")
+                self.handle(entry_id, fields)
+            if start_id == '0-0':
+                break
+        consumers = self.redis_server.xinfo_consumers(self.stream, self.group)
+        for consumer in consumers:
+            if consumer['name'] == self.consumer:
+                continue
+            if consumer['pending'] == 0 and consumer['idle'] > self.claim_idle:
+                log.info(f"Removing idle consumer {consumer['name']}")
+                self.redis_server.xgroup_delconsumer(self.stream, self.group,
+                                                     consumer['name'])
+
+    def handle(self, entry_id, fields):
+        """Handle a single stream entry, and acknowledge it if successful.
+        Failed entries are left pending, to be retried by the next instance
+        that claims them. Errors in `FATAL` are raised.
+        """
+        # Entries may have been trimmed from the stream while pending
+        if not fields:
+            self.redis_server.xack(self.stream, self.group, entry_id)
+            return
+        # Malformed entries would fail on every delivery
+        if 'data' not in fields:
+            log.error(f"Discarding {entry_id} with no data: {fields}")
+            self.redis_server.xack(self.stream, self.group, entry_id)
+            return
+        log.info(f"received entry {entry_id}: {fields}")
+        try:
+            pending = self.parse_msg(fields, entry_id)
+        except FATAL as e:
+            log.error(f"Cannot handle {entry_id}, stopping: {e}")
+            raise
+        except Exception as e:
+            log.error(f"Failed to handle {entry_id}: {e}")
+            return
+        # POINTING entries are acknowledged by `alert_delayed` instead
+        if not pending:
+            self.redis_server.xack(self.stream, self.group, entry_id)
+
+    def apply_update(self, band, source_ids, t, nsegs, nants, obsid,
+                     msg_id=None):
+        """Applies the scores for a completed subband together with a record
+        of its stream entry ID, so that an entry redelivered to another
+        instance is not applied twice.
+
+        Returns:
+            applied (bool): False if the entry had already been applied.
+        """
+        if not self.triage.update_targets(band, source_ids, t, nsegs, nants,
+                                          self.stream, msg_id, obsid):
+            log.warning(f"Update {msg_id} for {obsid} already applied")
+            return False
+        return True
+
+    def alert_delayed(self, obsid, delay, msg_id=None):
+        """Publish target alert after a delay, then acknowledge the POINTING
+        entry that requested it.
+        """
+        super().alert_delayed(obsid, delay, msg_id)
+        if msg_id is not None:
+            self.redis_server.xack(self.stream, self.group, msg_id)
@@ -1,5 +1,5 @@
 import mysql.connector
-from mysql.connector.errors import OperationalError
+from mysql.connector.errors import OperationalError, IntegrityError
 import yaml
 import scipy.constants as constants
 import json
@@ -30,8 +30,9 @@ class Triage:
         return mysql.connector.connect(**config)
 
 
-    def update(self, band, source_id, t, nsegs, nants):
-        """Atomic update of scores for specified sources.
+    def score_query(self, band, t, nsegs, nants):
+        """Score update query for a single source, and the score to be added
+        to it.
         """
         # Check input for `band`:
         if band not in self.valid_bands:
@@ -39,6 +40,12 @@ class Triage:
             raise ValueError
         delta_score = t*nsegs*nants
         update = f"UPDATE targets SET {band} = {band} + %s WHERE source_id = %s"
+        return update, delta_score
+
+    def update(self, band, source_id, t, nsegs, nants):
+        """Atomic update of scores for specified sources.
+        """
+        update, delta_score = self.score_query(band, t, nsegs, nants)
 
         with self.connection.cursor() as cursor:
         #cursor = self.connection.cursor()
@@ -46,6 +53,56 @@ class Triage:
             self.connection.commit()
         #cursor.close()
 
+    def create_ledger(self):
+        """Create the table recording which UPDATE messages have already been
+        applied (used when several selector instances share the work).
+        """
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS applied_updates "
+                "(stream VARCHAR(255), msg_id VARCHAR(64), obsid VARCHAR(255), "
+                "applied TIMESTAMP DEFAULT CURRENT_TIMESTAMP, "
+                "PRIMARY KEY (stream, msg_id), INDEX (stream, applied))"
+                )
+            self.connection.commit()
+
+    def update_targets(self, band, source_ids, t, nsegs, nants, stream,
+                       msg_id, obsid):
+        """Update scores for several sources in a single transaction,
+        recording `msg_id` (from `stream`) in the `applied_updates` table
+        alongside them.
+
+        Returns:
+            applied (bool): False if `msg_id` had already been applied, in
+            which case no scores are changed.
+        """
+        update, delta_score = self.score_query(band, t, nsegs, nants)
+        record = ("INSERT INTO applied_updates (stream, msg_id, obsid) "
+                  "VALUES (%s, %s, %s)")
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute(record, (stream, msg_id, obsid))
+                cursor.executemany(update,
+                                   [(delta_score, s) for s in source_ids])
+            self.connection.commit()
+        except IntegrityError:
+            self.connection.rollback()
+            return False
+        except Exception:
+            self.connection.rollback()
+            raise
+        return True
+
+    def prune_ledger(self, stream, max_age):
+        """Remove records of UPDATE messages from `stream` that were applied
+        more than `max_age` seconds ago.
+        """
+        prune = ("DELETE FROM applied_updates WHERE stream = %s "
+                 "AND applied < NOW() - INTERVAL %s SECOND")
+        with self.connection.cursor() as cursor:
+            cursor.execute(prune, (stream, max_age))
+            self.connection.commit()
+
     def get_targets(self, obsid, n):
         """Get the top <n> targets for a particular obsid.
         """
@@ -68,8 +125,9 @@ class Triage:
         values = (dec, dec, ra, r)
         return query, values
 
-    def rank_sources(self, ra_deg, dec_deg, d, f, band):
-        """Triage sources within search area.
+    def rank_sources(self, ra_deg, dec_deg, d, f, band, raise_errors=False):
+        """Triage sources within search area. If the database is not
+        available, an empty list is returned, unless `raise_errors` is set.
         """
         ra = np.deg2rad(ra_deg)
         dec = np.deg2rad(dec_deg)
@@ -90,6 +148,8 @@ class Triage:
             alert(self.r,
             f":warning: MySQL connection not available",
             "target selector")
+            if raise_errors:
+                raise
         return targets
 
     def format_targets(self, targets, pointing):
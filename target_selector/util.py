@@ -1,5 +1,7 @@
 from datetime import datetime, timezone
 
+from target_selector.logger import log
+
 SLACK_CHANNEL = "meerkat-obs-log"
 SLACK_PROXY_CHANNEL = "slack-messages"
 